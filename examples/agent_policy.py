@@ -13,6 +13,15 @@ from luxai2021.game.game_constants import GAME_CONSTANTS
 from luxai2021.game.position import Position
 
 
+# One-hot index of each direction in the observation
+DIRECTION_INDEX = {
+    Constants.DIRECTIONS.CENTER: 0,
+    Constants.DIRECTIONS.NORTH: 1,
+    Constants.DIRECTIONS.WEST: 2,
+    Constants.DIRECTIONS.SOUTH: 3,
+    Constants.DIRECTIONS.EAST: 4,
+}
+
 # https://codereview.stackexchange.com/questions/28207/finding-the-closest-point-to-a-list-of-points
 def closest_node(node, nodes):
     dist_2 = np.sum((nodes - node) ** 2, axis=1)
@@ -175,6 +184,7 @@ class AgentPolicy(AgentWithModel):
         self.observation_shape, dtype=np.float16)
 
         self.object_nodes = {}
+        self.turn_obs = np.zeros(11)
 
     def get_agent_type(self):
         """
@@ -185,9 +195,10 @@ class AgentPolicy(AgentWithModel):
         else:
             return Constants.AGENT_TYPE.AGENT
 
-    def get_observation(self, game, unit, city_tile, team, is_new_turn):
+    def get_observation(self, game, unit, city_tile, team, is_new_turn, out=None):
         """
-        Implements getting a observation from the current game for this unit or city
+        Implements getting a observation from the current game for this unit or city.
+        If `out` is specified, the observation is written into it instead of a new array.
         """
         observation_index = 0
         if is_new_turn:
@@ -195,20 +206,11 @@ class AgentPolicy(AgentWithModel):
             # Update any per-turn fixed observation space that doesn't change per unit/city controlled.
 
             # Build a list of object nodes by type for quick distance-searches
-            self.object_nodes = {}
+            object_nodes = {}
 
             # Add resources
             for cell in game.map.resources:
-                if cell.resource.type not in self.object_nodes:
-                    self.object_nodes[cell.resource.type] = np.array([[cell.pos.x, cell.pos.y]])
-                else:
-                    self.object_nodes[cell.resource.type] = np.concatenate(
-                        (
-                            self.object_nodes[cell.resource.type],
-                            [[cell.pos.x, cell.pos.y]]
-                        ),
-                        axis=0
-                    )
+                object_nodes.setdefault(cell.resource.type, []).append([cell.pos.x, cell.pos.y])
 
             # Add your own and opponent units
             for t in [team, (team + 1) % 2]:
@@ -216,17 +218,7 @@ class AgentPolicy(AgentWithModel):
                     key = str(u.type)
                     if t != team:
                         key = str(u.type) + "_opponent"
-
-                    if key not in self.object_nodes:
-                        self.object_nodes[key] = np.array([[u.pos.x, u.pos.y]])
-                    else:
-                        self.object_nodes[key] = np.concatenate(
-                            (
-                                self.object_nodes[key],
-                                [[u.pos.x, u.pos.y]]
-                            )
-                            , axis=0
-                        )
+                    object_nodes.setdefault(key, []).append([u.pos.x, u.pos.y])
 
             # Add your own and opponent cities
             for city in game.cities.values():
@@ -234,17 +226,13 @@ class AgentPolicy(AgentWithModel):
                     key = "city"
                     if city.team != team:
                         key = "city_opponent"
+                    object_nodes.setdefault(key, []).append([cells.pos.x, cells.pos.y])
 
-                    if key not in self.object_nodes:
-                        self.object_nodes[key] = np.array([[cells.pos.x, cells.pos.y]])
-                    else:
-                        self.object_nodes[key] = np.concatenate(
-                            (
-                                self.object_nodes[key],
-                                [[cells.pos.x, cells.pos.y]]
-                            )
-                            , axis=0
-                        )
+            # One array per type, built once instead of growing it per object
+            self.object_nodes = {key: np.array(nodes) for key, nodes in object_nodes.items()}
+
+            # The game state observations are the same for every unit and city this turn
+            self.get_turn_observation(game, team, out=self.turn_obs)
 
         # Observation space: (Basic minimum for a miner agent)
         # Object:
@@ -284,7 +272,11 @@ class AgentPolicy(AgentWithModel):
         #   1x research points [cur player]
         #   1x researched coal [cur player]
         #   1x researched uranium [cur player]
-        obs = np.zeros(self.observation_shape)
+        if out is None:
+            obs = np.zeros(self.observation_shape)
+        else:
+            obs = out
+            obs.fill(0)
         
         # Update the type of this object
         #   1x is worker
@@ -309,80 +301,75 @@ class AgentPolicy(AgentWithModel):
         if pos is None:
             observation_index += 7 * 5 * 2
         else:
-            # Encode the direction to the nearest objects
+            # Encode the direction to the nearest objects, then to the furthest ones
             #   5x direction_nearest
             #   1x distance
-            for distance_function in [closest_node, furthest_node]:
-                for key in [
-                    Constants.RESOURCE_TYPES.WOOD,
-                    Constants.RESOURCE_TYPES.COAL,
-                    Constants.RESOURCE_TYPES.URANIUM,
-                    "city",
-                    str(Constants.UNIT_TYPES.WORKER)]:
-                    # Process the direction to and distance to this object type
-
-                    # Encode the direction to the nearest object (excluding itself)
-                    #   5x direction
-                    #   1x distance
-                    if key in self.object_nodes:
-                        if (
-                                (key == "city" and city_tile is not None) or
-                                (unit is not None and str(unit.type) == key and len(game.map.get_cell_by_pos(unit.pos).units) <= 1 )
-                        ):
-                            # Filter out the current unit from the closest-search
-                            closest_index = closest_node((pos.x, pos.y), self.object_nodes[key])
-                            filtered_nodes = np.delete(self.object_nodes[key], closest_index, axis=0)
-                        else:
-                            filtered_nodes = self.object_nodes[key]
-
-                        if len(filtered_nodes) == 0:
+            keys = [
+                Constants.RESOURCE_TYPES.WOOD,
+                Constants.RESOURCE_TYPES.COAL,
+                Constants.RESOURCE_TYPES.URANIUM,
+                "city",
+                str(Constants.UNIT_TYPES.WORKER)]
+            for key_index, key in enumerate(keys):
+                # Process the direction to and distance to this object type
+
+                # Encode the direction to the nearest object (excluding itself)
+                #   5x direction
+                #   1x distance
+                if key in self.object_nodes:
+                    # Squared distances to all the objects of this type, shared by the nearest and furthest search
+                    nodes = self.object_nodes[key]
+                    dist_2 = np.sum((nodes - (pos.x, pos.y)) ** 2, axis=1)
+                    if (
+                            (key == "city" and city_tile is not None) or
+                            (unit is not None and str(unit.type) == key and len(game.map.get_cell_by_pos(unit.pos).units) <= 1 )
+                    ):
+                        # Filter out the current unit from the closest-search
+                        closest_index = np.argmin(dist_2)
+                        nodes = np.delete(nodes, closest_index, axis=0)
+                        dist_2 = np.delete(dist_2, closest_index)
+
+                    for function_index, distance_function in enumerate([np.argmin, np.argmax]):
+                        index = observation_index + (function_index * len(keys) + key_index) * 7
+                        if len(nodes) == 0:
                             # No other object of this type
-                            obs[observation_index + 5] = 1.0
+                            obs[index + 5] = 1.0
+                            continue
+
+                        # There is another object of this type
+                        closest = nodes[distance_function(dist_2)]
+                        closest_position = Position(closest[0], closest[1])
+                        direction = pos.direction_to(closest_position)
+                        obs[index + DIRECTION_INDEX[direction]] = 1.0  # One-hot encoding direction
+
+                        # 0 to 1 distance
+                        distance = pos.distance_to(closest_position)
+                        obs[index + 5] = min(distance / 20.0, 1.0)
+
+                        # 0 to 1 value (amount of resource, cargo for unit, or fuel for city)
+                        if key == "city":
+                            # City fuel as % of upkeep for 200 turns
+                            c = game.cities[game.map.get_cell_by_pos(closest_position).city_tile.city_id]
+                            obs[index + 6] = min(
+                                c.fuel / (c.get_light_upkeep() * 200.0),
+                                1.0
+                            )
+                        elif key in [Constants.RESOURCE_TYPES.WOOD, Constants.RESOURCE_TYPES.COAL,
+                                     Constants.RESOURCE_TYPES.URANIUM]:
+                            # Resource amount
+                            obs[index + 6] = min(
+                                game.map.get_cell_by_pos(closest_position).resource.amount / 500,
+                                1.0
+                            )
                         else:
-                            # There is another object of this type
-                            closest_index = distance_function((pos.x, pos.y), filtered_nodes)
-
-                            if closest_index is not None and closest_index >= 0:
-                                closest = filtered_nodes[closest_index]
-                                closest_position = Position(closest[0], closest[1])
-                                direction = pos.direction_to(closest_position)
-                                mapping = {
-                                    Constants.DIRECTIONS.CENTER: 0,
-                                    Constants.DIRECTIONS.NORTH: 1,
-                                    Constants.DIRECTIONS.WEST: 2,
-                                    Constants.DIRECTIONS.SOUTH: 3,
-                                    Constants.DIRECTIONS.EAST: 4,
-                                }
-                                obs[observation_index + mapping[direction]] = 1.0  # One-hot encoding direction
-
-                                # 0 to 1 distance
-                                distance = pos.distance_to(closest_position)
-                                obs[observation_index + 5] = min(distance / 20.0, 1.0)
-
-                                # 0 to 1 value (amount of resource, cargo for unit, or fuel for city)
-                                if key == "city":
-                                    # City fuel as % of upkeep for 200 turns
-                                    c = game.cities[game.map.get_cell_by_pos(closest_position).city_tile.city_id]
-                                    obs[observation_index + 6] = min(
-                                        c.fuel / (c.get_light_upkeep() * 200.0),
-                                        1.0
-                                    )
-                                elif key in [Constants.RESOURCE_TYPES.WOOD, Constants.RESOURCE_TYPES.COAL,
-                                             Constants.RESOURCE_TYPES.URANIUM]:
-                                    # Resource amount
-                                    obs[observation_index + 6] = min(
-                                        game.map.get_cell_by_pos(closest_position).resource.amount / 500,
-                                        1.0
-                                    )
-                                else:
-                                    # Unit cargo
-                                    obs[observation_index + 6] = min(
-                                        next(iter(game.map.get_cell_by_pos(
-                                            closest_position).units.values())).get_cargo_space_left() / 100,
-                                        1.0
-                                    )
-
-                    observation_index += 7
+                            # Unit cargo
+                            obs[index + 6] = min(
+                                next(iter(game.map.get_cell_by_pos(
+                                    closest_position).units.values())).get_cargo_space_left() / 100,
+                                1.0
+                            )
+
+            observation_index += 7 * len(keys) * 2
 
         if unit is not None:
             # Encode the cargo space
@@ -394,6 +381,21 @@ class AgentPolicy(AgentWithModel):
             observation_index += 1
 
         # Game state observations
+        obs[observation_index:] = self.turn_obs
+
+        return obs
+
+    def get_turn_observation(self, game, team, out=None):
+        """
+        Implements the game state part of the observation, which only changes once per turn.
+        If `out` is specified, the observation is written into it instead of a new array.
+        """
+        if out is None:
+            obs = np.zeros(11)
+        else:
+            obs = out
+            obs.fill(0)
+        observation_index = 0
 
         #   1x is night
         obs[observation_index] = game.is_night()
@@ -508,21 +510,10 @@ class AgentPolicy(AgentWithModel):
         # Get some basic stats
         unit_count = len(game.state["teamStates"][self.team]["units"])
 
-        city_count = 0
-        city_count_opponent = 0
         city_tile_count = 0
-        city_tile_count_opponent = 0
         for city in game.cities.values():
             if city.team == self.team:
-                city_count += 1
-            else:
-                city_count_opponent += 1
-
-            for cell in city.city_cells:
-                if city.team == self.team:
-                    city_tile_count += 1
-                else:
-                    city_tile_count_opponent += 1
+                city_tile_count += len(city.city_cells)
         
         rewards = {}
         
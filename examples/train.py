@@ -3,34 +3,29 @@ import glob
 import os
 import sys
 import random
+from functools import partial
 
 from stable_baselines3 import PPO  # pip install stable-baselines3
 from stable_baselines3.common.callbacks import EvalCallback
-from stable_baselines3.common.utils import set_random_seed, get_schedule_fn
-from stable_baselines3.common.vec_env import SubprocVecEnv
+from stable_baselines3.common.utils import get_schedule_fn
 
 from agent_policy import AgentPolicy
 from luxai2021.env.agent import Agent
 from luxai2021.env.lux_env import LuxEnvironment, SaveReplayAndModelCallback
+from luxai2021.env.vec_env import make_lux_vec_env
 from luxai2021.game.constants import LuxMatchConfigs_Default
 
 
-# https://stable-baselines3.readthedocs.io/en/master/guide/examples.html?highlight=SubprocVecEnv#multiprocessing-unleashing-the-power-of-vectorized-environments
-def make_env(local_env, rank, seed=0):
+def make_replay_env(model_path):
     """
-    Utility function for multi-processed env.
-
-    :param local_env: (LuxEnvironment) the environment 
-    :param seed: (int) the initial seed for RNG
-    :param rank: (int) index of the subprocess
+    Creates the environment used to generate replays of a saved model
+    :param model_path: (str) Path to the saved model
+    :return: (LuxEnvironment) The replay environment
     """
-
-    def _init():
-        local_env.seed(seed + rank)
-        return local_env
-
-    set_random_seed(seed)
-    return _init
+    model = PPO.load(model_path)
+    return LuxEnvironment(configs=LuxMatchConfigs_Default,
+                          learning_agent=AgentPolicy(mode="inference", model=model),
+                          opponent_agents={"default": Agent()})
 
 
 def get_command_line_arguments():
@@ -65,6 +60,7 @@ def train(args):
 
     # Create a default opponent agent
     opponent = Agent()
+    make_opponents = lambda: {"default": Agent()}
 
     # Create a RL agent in training mode
     player = AgentPolicy(mode="train")
@@ -74,11 +70,9 @@ def train(args):
     if args.n_envs == 1:
         env = LuxEnvironment(configs=configs,
                              learning_agent=player,
-                             opponent_agent=opponent)
+                             opponent_agents={"default": opponent})
     else:
-        env = SubprocVecEnv([make_env(LuxEnvironment(configs=configs,
-                                                     learning_agent=AgentPolicy(mode="train"),
-                                                     opponent_agent=opponent), i) for i in range(args.n_envs)])
+        env = make_lux_vec_env(args.n_envs, configs, partial(AgentPolicy, mode="train"), make_opponents)
     
     run_id = args.id
     print("Run id %s" % run_id)
@@ -108,18 +102,14 @@ def train(args):
     
     callbacks = []
 
-    # Save a checkpoint and 5 match replay files every 100K steps
-    player_replay = AgentPolicy(mode="inference", model=model)
+    # Save a checkpoint and 5 match replay files every 100K steps. The replays run in a background process.
+    # The callback is called once per step of all the environments.
     callbacks.append(
         SaveReplayAndModelCallback(
-                                save_freq=100000,
+                                save_freq=max(100000 // args.n_envs, 1),
                                 save_path='./models/',
                                 name_prefix=f'model{run_id}',
-                                replay_env=LuxEnvironment(
-                                                configs=configs,
-                                                learning_agent=player_replay,
-                                                opponent_agent=Agent()
-                                ),
+                                replay_env_fn=make_replay_env,
                                 replay_num_episodes=5
                             )
     )
@@ -128,9 +118,7 @@ def train(args):
     # for metrics.
     if args.n_envs > 1:
         # An evaluation environment is needed to measure multi-env setups. Use a fixed 4 envs.
-        env_eval = SubprocVecEnv([make_env(LuxEnvironment(configs=configs,
-                                                     learning_agent=AgentPolicy(mode="train"),
-                                                     opponent_agent=opponent), i) for i in range(4)])
+        env_eval = make_lux_vec_env(4, configs, partial(AgentPolicy, mode="train"), make_opponents)
 
         callbacks.append(
             EvalCallback(env_eval, best_model_save_path=f'./logs_{run_id}/',
@@ -1,10 +1,18 @@
+import copy
 import sys
 import time
+from collections import OrderedDict
 
 import numpy as np
 from gym import spaces
 from ..game.constants import Constants
 
+# Models loaded by AgentWithModel.set_model(), most recently used last. Shared by
+# all the agents of the process, so opponents switching between checkpoints don't reload them.
+# Kept small, every environment worker holds its own cache.
+_MODEL_CACHE = OrderedDict()
+_MODEL_CACHE_SIZE = 2
+
 """
 Implements the base class for a training Agent
 """
@@ -153,12 +161,78 @@ class AgentWithModel(Agent):
         delta increment to the reward, not the total current reward.
         """
         return 0
+
+    def set_model(self, path=None):
+        """
+        Switches the model to the one saved at path, eg by the self-play opponent
+        switching. Recently used checkpoints are cached, switching back to one of
+        them doesn't load it again. Without a path, the model is kept as is.
+        """
+        if path is None:
+            return
+
+        model = _MODEL_CACHE.get(path)
+        if model is None:
+            model = self.load_model(path)
+            _MODEL_CACHE[path] = model
+            if len(_MODEL_CACHE) > _MODEL_CACHE_SIZE:
+                _MODEL_CACHE.popitem(last=False)
+        else:
+            _MODEL_CACHE.move_to_end(path)
+        self.model = model
+
+    def set_parameters(self, parameters):
+        """
+        Copies the specified weights into the current model, in place. The parameters are
+        a state_dict() of the policy for stable_baselines3 models, or of the model itself for
+        torch modules. See lux_env.get_policy_parameters().
+        """
+        if any(model is self.model for model in _MODEL_CACHE.values()):
+            # Models loaded by set_model() are shared through the cache, update a copy
+            # instead of the cached checkpoint
+            self.model = copy.deepcopy(self.model)
+        self._get_module().load_state_dict(parameters)
+
+    def share_memory(self):
+        """
+        Moves the weights of the current model to shared memory. Environments forked afterwards,
+        eg by SubprocVecEnv(..., start_method="fork"), then all use these weights instead of each
+        keeping a copy, and set_parameters() in this process updates all of them at once.
+        Other start methods pickle the model, which copies the weights again.
+        """
+        self._get_module().share_memory()
+        return self
+
+    def _get_module(self):
+        """
+        Returns the torch module holding the weights of the model.
+        """
+        if self.model is None:
+            raise ValueError("The agent has no model.")
+        return self.model.policy if hasattr(self.model, "policy") else self.model
+
+    def load_model(self, path):
+        """
+        Loads the model saved at path, called by set_model() on a cache miss. Override
+        this for models that aren't saved with torch.save().
+        """
+        import torch
+
+        model = torch.load(path, map_location="cpu")
+        if isinstance(model, torch.nn.Module):
+            model.eval()
+        return model
     
-    def get_observation(self, game, unit, city_tile, team, is_new_turn):
+    def get_observation(self, game, unit, city_tile, team, is_new_turn, out=None):
         """
-        Implements getting a observation from the current game for this unit or city
+        Implements getting a observation from the current game for this unit or city.
+        If `out` is specified, the observation is written into it and returned, this
+        avoids allocating a new observation every step.
         """
-        return np.zeros((10,1))
+        if out is None:
+            return np.zeros((10,1))
+        out.fill(0)
+        return out
 
     def process_turn(self, game, team):
         """
@@ -170,36 +244,36 @@ class AgentWithModel(Agent):
         actions = []
         new_turn = True
 
-        # Inference the model per-unit
+        # Observe every unit, then city, that can act. The observations are collected first
+        # so the model is inferenced once for all of them instead of once per unit or city.
+        actionables = []
+        observations = []
         units = game.state["teamStates"][team]["units"].values()
         for unit in units:
             if unit.can_act():
-                obs = self.get_observation(game, unit, None, unit.team, new_turn)
-                # IMPORTANT: You can change deterministic=True to disable randomness in model inference. Generally,
-                # I've found the agents get stuck sometimes if they are fully deterministic.
-                action_code, _states = self.model.predict(obs, deterministic=False)
-                if action_code is not None:
-                    actions.append(
-                        self.action_code_to_action(action_code, game=game, unit=unit, city_tile=None, team=unit.team))
+                actionables.append((unit, None, unit.team))
+                observations.append(self.get_observation(game, unit, None, unit.team, new_turn))
                 new_turn = False
 
-        # Inference the model per-city
         cities = game.cities.values()
         for city in cities:
             if city.team == team:
                 for cell in city.city_cells:
                     city_tile = cell.city_tile
                     if city_tile.can_act():
-                        obs = self.get_observation(game, None, city_tile, city.team, new_turn)
-                        # IMPORTANT: You can change deterministic=True to disable randomness in model inference. Generally,
-                        # I've found the agents get stuck sometimes if they are fully deterministic.
-                        action_code, _states = self.model.predict(obs, deterministic=False)
-                        if action_code is not None:
-                            actions.append(
-                                self.action_code_to_action(action_code, game=game, unit=None, city_tile=city_tile,
-                                                           team=city.team))
+                        actionables.append((None, city_tile, city.team))
+                        observations.append(self.get_observation(game, None, city_tile, city.team, new_turn))
                         new_turn = False
 
+        if observations:
+            # IMPORTANT: You can change deterministic=True to disable randomness in model inference. Generally,
+            # I've found the agents get stuck sometimes if they are fully deterministic.
+            action_codes, _states = self.model.predict(np.stack(observations), deterministic=False)
+            for (unit, city_tile, unit_team), action_code in zip(actionables, action_codes):
+                if action_code is not None:
+                    actions.append(
+                        self.action_code_to_action(action_code, game=game, unit=unit, city_tile=city_tile, team=unit_team))
+
         time_taken = time.time() - start_time
         if time_taken > 0.5:  # Warn if larger than 0.5 seconds.
             print("WARNING: Inference took %.3f seconds for computing actions. Limit is 1 second." % time_taken,
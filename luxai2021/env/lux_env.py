@@ -1,19 +1,84 @@
 """
 Implements the base class for a Lux environment
 """
-import traceback
+import functools
+import inspect
+import logging
+import multiprocessing
 import gym
 import os
-import copy
-import glob
 import random  
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from stable_baselines3.common.callbacks import BaseCallback
 
 from ..game.game import Game
 from ..game.match_controller import GameStepFailedException, MatchController
+from ..game.replay import flush_replays
 from ..game.constants import Constants
 
+logger = logging.getLogger(__name__)
+
+_AGENT_TYPE_AGENT = Constants.AGENT_TYPE.AGENT
+
+# Opponent policy names
+_SELF_PLAY = "self-play"
+_IMITATION = "imitation"
+
+
+def get_policy_parameters(model):
+    """
+    Returns a CPU copy of the policy weights of a stable_baselines3 model, without its
+    optimizer or rollout buffer. Use it to update the self-play opponents of running
+    environments in place, eg:
+        env.env_method("update_opponent", get_policy_parameters(model))
+    """
+    return {k: v.detach().cpu().clone() for k, v in model.policy.state_dict().items()}
+
+
+def _get_mp_context():
+    """
+    Returns the multiprocessing context for background workers. Same default as
+    SubprocVecEnv, since fork is not thread safe.
+    """
+    forkserver_available = "forkserver" in multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if forkserver_available else "spawn")
+
+
+def _run_replay_episode(replay_env, replay_folder, replay_prefix, seed):
+    """
+    Runs a whole game with the replay environment, saving the replay.
+    """
+    replay_env.game.configs["seed"] = seed
+    replay_env.set_replay_path(replay_folder, replay_prefix)
+
+    replay_env.reset() # Runs  a whole game because no training agent is attached
+
+
+def _init_replay_worker():
+    """
+    Limits the replay workers to one torch thread each, so they don't compete with
+    training for every core.
+    """
+    import torch
+    torch.set_num_threads(1)
+
+
+def _run_replays(replay_env_fn, model_path, replay_folder, replay_prefixes_and_seeds):
+    """
+    Runs a batch of replay games in a background process. The replay environment is created
+    once for the batch from the saved model, instead of pickling the live one.
+    """
+    replay_env = replay_env_fn(model_path)
+    for replay_prefix, seed in replay_prefixes_and_seeds:
+        try:
+            _run_replay_episode(replay_env, replay_folder, replay_prefix, seed)
+        except Exception:
+            logger.exception("Replay environment failed on seed %d", seed)
+
+    # The pool worker exits without running atexit handlers
+    flush_replays()
+
 
 class SaveReplayAndModelCallback(BaseCallback):
     """
@@ -28,52 +93,100 @@ class SaveReplayAndModelCallback(BaseCallback):
 
     :param save_freq:
     :param save_path: Path to the folder where the model will be saved.
+    :param replay_env: Environment used to run the replay games in the training process.
+    :param replay_num_episodes: Number of replay games for each saved model.
     :param name_prefix: Common prefix to the saved models
     :param verbose:
+    :param replay_env_fn: Optional picklable function that takes the path of a saved model and
+        returns the replay environment. When set, the replay games run in background
+        processes so that training doesn't wait for them, and replay_env isn't needed.
+    :param replay_num_workers: Number of background processes running the replay games, each one
+        runs its share of the replay_num_episodes games with a single replay environment, and
+        keeps torch and the model loaded for the whole training. Defaults to 2.
     """
 
-    def __init__(self, save_freq: int, save_path: str, replay_env, replay_num_episodes=5, name_prefix: str = "rl_model", verbose: int = 0):
+    def __init__(self, save_freq: int, save_path: str, replay_env=None, replay_num_episodes=5, name_prefix: str = "rl_model", verbose: int = 0, replay_env_fn=None, replay_num_workers=None):
         super(SaveReplayAndModelCallback, self).__init__(verbose)
+        if replay_env is None and replay_env_fn is None:
+            raise ValueError("Either replay_env or replay_env_fn must be specified.")
+
         self.save_freq = save_freq
         self.save_path = save_path
         self.name_prefix = name_prefix
         self.replay_env = replay_env
+        self.replay_env_fn = replay_env_fn
         self.replay_num_episodes = replay_num_episodes
+        if replay_num_workers is None:
+            replay_num_workers = max(1, min(replay_num_episodes, 2))
+        self.replay_num_workers = replay_num_workers
+        self._replay_executor = None
+        self._pending_replays = []
         print(f"Logging models and replays to '{self.save_path}'.")
 
     def _init_callback(self) -> None:
         # Create folder if needed
         if self.save_path is not None:
             os.makedirs(self.save_path, exist_ok=True)
+            self._path_prefix = os.path.join(self.save_path, self.name_prefix)
+
+        if self.replay_env_fn is not None and self._replay_executor is None:
+            self._replay_executor = ProcessPoolExecutor(
+                max_workers=self.replay_num_workers, mp_context=_get_mp_context(), initializer=_init_replay_worker
+            )
+
+    def _on_training_end(self) -> None:
+        # Let the last replays finish and report their failures
+        if self._replay_executor is not None:
+            self._replay_executor.shutdown(wait=True)
+            self._replay_executor = None
+            self._reap_replays()
 
     def _on_step(self) -> bool:
+        self._reap_replays()
+
         if self.n_calls % self.save_freq == 0:
             # Save the model
-            path = os.path.join(self.save_path, f"{self.name_prefix}_step{self.num_timesteps}")
+            path = f"{self._path_prefix}_step{self.num_timesteps}"
             self.model.save(path)
             
             # Run a bunch of games to creates replays using the replay environment
-            for i in range(self.replay_num_episodes):
-                self.replay_env.game.configs["seed"] = i
-                self.replay_env.set_replay_path(self.save_path, f"{self.name_prefix}_step{self.num_timesteps}_seed{i}")
-
-                try:
-                    self.replay_env.reset() # Runs  a whole game because no training agent is attached
-                except StopIteration:
-                    # Game finished successfully
-                    pass
-                except Exception as e:
-                    # Failure
-                    print("Replay environment failed.")
-                    print(repr(e))
-                    print(''.join(traceback.format_exception(None, e, e.__traceback__)))
-                    pass
-                
+            replays = [(f"{self.name_prefix}_step{self.num_timesteps}_seed{i}", i) for i in range(self.replay_num_episodes)]
+
+            if self.replay_env_fn is not None:
+                # Run in the background, one batch per worker so each of them loads the model once.
+                # Failures to create the replay environment are reported by _reap_replays()
+                for w in range(self.replay_num_workers):
+                    batch = replays[w::self.replay_num_workers]
+                    if batch:
+                        self._pending_replays.append(
+                            self._replay_executor.submit(_run_replays, self.replay_env_fn, path, self.save_path, batch)
+                        )
+            else:
+                for replay_prefix, i in replays:
+                    try:
+                        _run_replay_episode(self.replay_env, self.save_path, replay_prefix, i)
+                    except Exception:
+                        logger.exception("Replay environment failed on seed %d", i)
             
             if self.verbose > 1:
                 print(f"Saved model checkpoint and replay to {path}")
         return True
 
+    def _reap_replays(self):
+        """
+        Reports the failures of the finished background replay games, without waiting.
+        """
+        if not self._pending_replays:
+            return
+
+        pending = []
+        for future in self._pending_replays:
+            if not future.done():
+                pending.append(future)
+            elif future.exception() is not None:
+                logger.error("Replay environment failed", exc_info=future.exception())
+        self._pending_replays = pending
+
 
 class LuxEnvironment(gym.Env):
     """
@@ -81,23 +194,31 @@ class LuxEnvironment(gym.Env):
     """
     metadata = {'render.modes': ['human']}
 
+    # Placeholder spaces for agents that don't declare them, eg inference-only agents
+    action_space = gym.spaces.Discrete(1)
+    observation_space = gym.spaces.Box(low=0, high=1, shape=(1,), dtype=np.float32)
+
     def __init__(
         self, 
         configs, 
         learning_agent, 
         opponent_agents, 
-        initial_opponent_policy="self-play", 
+        initial_opponent_policy=_SELF_PLAY, 
         model_update_step_freq=None,
         model_save_path=None,  
         replay_validate=None, 
         replay_folder=None, 
-        replay_prefix="replay"
+        replay_prefix="replay",
+        autoreset=False
         ):
         """
         THe initializer
         :param configs:
         :param learning_agent:
         :param opponent_agent:
+        :param autoreset: If True, step() starts the next game as soon as one ends. It then returns
+            the first observation of the new game, and info["terminal_observation"] is None since
+            there is no unit or city left to observe at the end of a game.
         """
         super(LuxEnvironment, self).__init__()
 
@@ -119,27 +240,84 @@ class LuxEnvironment(gym.Env):
         self.replay_folder = replay_folder
         self.model_update_step_freq = model_update_step_freq
         self.model_save_path = model_save_path 
+        self.autoreset = autoreset
 
-        self.action_space = []
-        if hasattr( learning_agent, 'action_space' ):
-            self.action_space = learning_agent.action_space
-        
-        self.observation_space = {}
-        if hasattr( learning_agent, 'observation_space' ):
-            self.observation_space = learning_agent.observation_space
+        # The spaces of the learning agent, or the class placeholders if it doesn't declare them
+        for name in ("action_space", "observation_space"):
+            space = getattr(learning_agent, name, None)
+            if space is not None:
+                if not isinstance(space, gym.spaces.Space):
+                    raise TypeError(f"The {name} of the learning agent must be a gym space, got {type(space).__name__}.")
+                setattr(self, name, space)
 
         self.learning_agent = learning_agent
         self.opponent_agents = opponent_agents
         self.opponent_agent = opponent_agent
 
+        # Opponent policies drawn by switch_opponent_policy(), half of the time each. None keeps
+        # the current policy, it takes the share of the policies that aren't available.
+        selfplay_weight = 0.5 if _SELF_PLAY in opponent_agents else 0.0
+        imitation_weight = 0.5 if _IMITATION in opponent_agents else 0.0
+        self._switch_pop = [_SELF_PLAY, _IMITATION, None]
+        self._switch_cum_weights = [selfplay_weight, selfplay_weight + imitation_weight, 1.0]
+
+        # Bind the observation functions once, they are called every step. Inference-only
+        # agents, as used for replays, don't implement them.
+        self._get_obs = getattr(learning_agent, "get_observation", None)
+        self._has_base = hasattr(learning_agent, "get_base_observation")
+        self._get_base = learning_agent.get_base_observation if self._has_base else None
+
+        # Agents that accept an `out` array fill preallocated observations instead of
+        # allocating a new one every step. Two buffers are used in turn, the returned
+        # observation is read-only and stays valid until the step after next.
+        self._obs_bufs = None
+        if (
+            self._get_obs is not None and 
+            isinstance(getattr(learning_agent, 'observation_space', None), gym.spaces.Box) and 
+            "out" in inspect.signature(self._get_obs).parameters
+        ):
+            self._obs_bufs = [
+                np.zeros(self.observation_space.shape, dtype=self.observation_space.dtype) for _ in range(2)
+            ]
+            self._obs_fns = [functools.partial(self._get_obs, out=buf) for buf in self._obs_bufs]
+            self._obs_idx = 0
+            self._get_obs = self._obs_fns[0]
+
+        # Observation used by step(), picked once instead of checking the agent every step
+        self._observe = self._observe_with_base if self._has_base else self._observe_plain
+
+        # The other calls of step(), bound once as well
+        self._take_action = getattr(learning_agent, "take_action", None)
+        self._get_reward = getattr(learning_agent, "get_reward", None)
+        self._advance = self.match_controller.advance
+
         self.current_step = 0
         self.total_env_step = 0 
-        self.match_generator = None
-
-        self.last_observation_object = None
+        # Step of the next opponent policy switch, None if they are disabled or there is
+        # only one opponent to switch to
+        self._next_update_step = None
+        if model_update_step_freq and len(opponent_agents) > 1:
+            self._next_update_step = model_update_step_freq
+
+        # The unit or city that the last observation was for
+        self._last_unit = None
+        self._last_city_tile = None
+        self._last_team = None
+        self._last_is_new_turn = None
         self.num_switch = 0
         self.last_unit_obs = None
+
+        # Saved self-play models, cached until the model folder changes
+        self._model_cache = {"mtime": None, "sorted": []}
+
         
+    @property
+    def last_observation_object(self):
+        """
+        (unit, city_tile, team, is_new_turn) of the last observation, kept for compatibility.
+        """
+        return (self._last_unit, self._last_city_tile, self._last_team, self._last_is_new_turn)
+
     def set_replay_path(self, replay_folder, replay_prefix):
         """
         Override the replay prefix
@@ -150,6 +328,23 @@ class LuxEnvironment(gym.Env):
         self.replay_prefix = replay_prefix
         self.replay_folder = replay_folder
 
+    def _flip_obs_buf(self):
+        """
+        Hands the observation buffer that was just filled to the caller as read-only,
+        the next observation is written into the other one.
+        """
+        self._obs_bufs[self._obs_idx].flags.writeable = False
+        self._obs_idx ^= 1
+        self._obs_bufs[self._obs_idx].flags.writeable = True
+        self._get_obs = self._obs_fns[self._obs_idx]
+
+    def _observe_with_base(self, unit, city_tile, team, is_new_turn):
+        base_obs = self._get_base(self.game, team, self.last_unit_obs)
+        return self._get_obs(self.game, unit, city_tile, team, is_new_turn, base_obs)
+
+    def _observe_plain(self, unit, city_tile, team, is_new_turn):
+        return self._get_obs(self.game, unit, None, team)
+
     def step(self, action_code):
         """
         Take this action, then get the state at the next action
@@ -157,57 +352,68 @@ class LuxEnvironment(gym.Env):
         :return:
         """
         # Decision for 1 unit or city
-        self.learning_agent.take_action(action_code,
-                                        self.game,
-                                        unit=self.last_observation_object[0],
-                                        city_tile=self.last_observation_object[1],
-                                        team=self.last_observation_object[2]
-                                        )
+        self._take_action(action_code,
+                          self.game,
+                          unit=self._last_unit,
+                          city_tile=self._last_city_tile,
+                          team=self._last_team
+                          )
 
         self.current_step += 1
-        self.total_env_step += 1
+        total_env_step = self.total_env_step + 1
+        self.total_env_step = total_env_step
 
         # Get the next observation
         is_new_turn = True
-        is_game_over = False
         is_game_error = False
+        obs = None
         try:
-            (unit, city_tile, team, is_new_turn) = next(self.match_generator)
-            if hasattr(self.learning_agent, "get_base_observation"):
-                base_obs = self.learning_agent.get_base_observation(self.game,  team, self.last_unit_obs)
-                obs = self.learning_agent.get_observation(self.game, unit, city_tile, team, is_new_turn, base_obs)
-            else:
-                obs = self.learning_agent.get_observation(self.game, unit, None, team)
-
-            # self.learning_agent.get_last_observation(base_obs)
-            self.last_observation_object = (unit, city_tile, team, is_new_turn)
-        except StopIteration:
-            # The game episode is done.
-            is_game_over = True
-            obs = None
+            observation = self._advance()
         except GameStepFailedException:
             # Game step failed, assign a game lost reward to not incentivise this
-            is_game_over = True
-            obs = None
+            observation = None
             is_game_error = True
 
+        # The game episode is done when there is nothing left to observe
+        is_game_over = observation is None
+        if not is_game_over:
+            (unit, city_tile, team, is_new_turn) = observation
+            obs = self._observe(unit, city_tile, team, is_new_turn)
+            if self._obs_bufs is not None:
+                self._flip_obs_buf()
+
+            # self.learning_agent.get_last_observation(base_obs)
+            self._last_unit = unit
+            self._last_city_tile = city_tile
+            self._last_team = team
+            self._last_is_new_turn = is_new_turn
+
         # Calculate reward for this step
-        reward = self.learning_agent.get_reward(self.game, is_game_over, is_new_turn, is_game_error)
+        reward = self._get_reward(self.game, is_game_over, is_new_turn, is_game_error)
 
-        if self.model_update_step_freq != None:
-            # switch opponent policy in training
-            if (len(self.opponent_agents) > 1)&(self.total_env_step % self.model_update_step_freq == 0):
-                self.switch_opponent_policy()
+        if self._next_update_step is not None and total_env_step >= self._next_update_step:
+            # switch opponent policy in training, next at the following multiple of the frequency,
+            # also when total_env_step was set past this one (eg restored when resuming)
+            freq = self.model_update_step_freq
+            self._next_update_step = (total_env_step // freq + 1) * freq
+            self.switch_opponent_policy()
+
+        if is_game_over and self.autoreset:
+            return self.reset(), reward, is_game_over, {"terminal_observation": obs}
             
         return obs, reward, is_game_over, {}  # self.learning_agent.rewards
 
-    def reset(self):
+    def reset(self, last_unit_obs=None):
         """
 
-        :return:
+        :param last_unit_obs: Passed to get_base_observation() for the observations of the new game.
+            Defaults to None, so nothing from the previous game leaks into the new one.
+        :return: The first observation, or None if the whole game ran without needing
+                 the learning agent (eg both agents in inference mode).
         """
         self.current_step = 0
-        self.last_observation_object = None
+        self._last_unit = self._last_city_tile = self._last_team = self._last_is_new_turn = None
+        self.last_unit_obs = last_unit_obs
 
         # Reset game + map
         self.match_controller.reset()
@@ -215,15 +421,23 @@ class LuxEnvironment(gym.Env):
             # Tell the game to log replays
             self.game.start_replay_logging(stateful=True, replay_folder=self.replay_folder, replay_filename_prefix=self.replay_prefix)
 
-        self.match_generator = self.match_controller.run_to_next_observation()
-        (unit, city_tile, team, is_new_turn) = next(self.match_generator)
+        observation = self.match_controller.advance()
+        if observation is None:
+            # The whole game was played without the learning agent, eg replay generation
+            return None
+        (unit, city_tile, team, is_new_turn) = observation
 
-        if hasattr(self.learning_agent, "get_base_observation"):
-            base_obs = self.learning_agent.get_base_observation(self.game,  team, self.last_unit_obs)
-            obs = self.learning_agent.get_observation(self.game, unit, city_tile, team, is_new_turn, base_obs)
+        if self._has_base:
+            base_obs = self._get_base(self.game, team, self.last_unit_obs)
+            obs = self._get_obs(self.game, unit, city_tile, team, is_new_turn, base_obs)
         else:  # for Unet
-            obs = self.learning_agent.get_observation(self.game, unit, city_tile, team)
-        self.last_observation_object = (unit, city_tile, team, is_new_turn)
+            obs = self._get_obs(self.game, unit, city_tile, team)
+        if self._obs_bufs is not None:
+            self._flip_obs_buf()
+        self._last_unit = unit
+        self._last_city_tile = city_tile
+        self._last_team = team
+        self._last_is_new_turn = is_new_turn
         return obs
 
     def render(self, **kwargs):
@@ -241,19 +455,18 @@ class LuxEnvironment(gym.Env):
         Both agents have to be in inference mode
         """
 
-        for agent in self.match_controller.agents:
-            assert agent.get_agent_type() == Constants.AGENT_TYPE.AGENT, "Both agents must be in inference mode"
+        assert all(agent.get_agent_type() == _AGENT_TYPE_AGENT for agent in self.match_controller.agents), \
+            "Both agents must be in inference mode"
 
         self.current_step = 0
-        self.last_observation_object = None
+        self._last_unit = self._last_city_tile = self._last_team = self._last_is_new_turn = None
 
         # Reset game + map
         self.match_controller.reset(randomize_team_order=False)
-        # Running
-        self.match_generator = self.match_controller.run_to_next_observation()
+        # Running, advance() returns None once the game is over
         try:
-            next(self.match_generator)
-        except StopIteration:
+            while self.match_controller.advance() is not None:
+                pass
             # The game episode is done.
             is_game_error = False
             print('Episode run finished successfully!')
@@ -265,34 +478,65 @@ class LuxEnvironment(gym.Env):
     
     def opponent_model_update(self):
         # for self-play
-        if self.opponent_policy == 'self-play':
-            # models = glob.glob(str(self.model_save_path)+'/rl_cnn_model_*_steps.onnx')
-            models = glob.glob(str(self.model_save_path)+'/rl_cnn_model_*_steps.pth')
+        if self.opponent_policy == _SELF_PLAY:
+            models = self.get_opponent_models()
             p = random.random()
             if p < 0.5:  # sampling old model
                 pretrained_model_path = random.choice(models)
             else:  # latest model
-                pretrained_model_path = sorted(models, key=lambda x: int(x.split('_')[-2]), reverse=True)[0]
+                pretrained_model_path = models[0]
             self.opponent_agent.set_model(pretrained_model_path)
 
         # for imitation agent
-        elif self.opponent_policy == 'imitation':
+        elif self.opponent_policy == _IMITATION:
             self.opponent_agent.set_model()
 
+    def update_opponent(self, parameters, policy=_SELF_PLAY):
+        """
+        Copies the specified weights into the model of an opponent, see get_policy_parameters().
+        """
+        self.opponent_agents[policy].set_parameters(parameters)
+
     def is_valid_opponent_model_update(self):
-        # return len(glob.glob(str(self.model_save_path)+'/rl_cnn_model_*_steps.onnx')) > 0
-        return len(glob.glob(str(self.model_save_path)+'/rl_cnn_model_*_steps.pth')) > 0
+        return len(self.get_opponent_models()) > 0
+
+    def get_opponent_models(self):
+        """
+        Returns the paths of the saved self-play models, sorted latest step first.
+        The folder listing is cached until the folder is modified.
+        """
+        if self.model_save_path is None:
+            return []
+
+        try:
+            mtime = os.stat(self.model_save_path).st_mtime_ns
+        except FileNotFoundError:
+            return []
+
+        if mtime != self._model_cache["mtime"]:
+            models = []
+            with os.scandir(self.model_save_path) as entries:
+                for entry in entries:
+                    # Named as rl_cnn_model_<step>_steps.pth
+                    if entry.name.startswith("rl_cnn_model_") and entry.name.endswith("_steps.pth"):
+                        models.append((int(entry.name.rsplit('_', 2)[-2]), entry.path))
+            models.sort(reverse=True)
+            self._model_cache = {"mtime": mtime, "sorted": [path for _, path in models]}
+
+        return self._model_cache["sorted"]
     
     def switch_opponent_policy(self):
         current_opponent_policy = self.opponent_policy
         new_opponent_policy = self.opponent_policy
         self.num_switch += 1
-        p = random.random()
+
+        policy = random.choices(self._switch_pop, cum_weights=self._switch_cum_weights)[0]
+
         # self-play modelを読み込むとkilledになる
-        if (p < 0.5)&("self-play" in self.opponent_agents.keys())&(self.is_valid_opponent_model_update()):
-            new_opponent_policy = "self-play"
-        elif (0.5 <= p)&("imitation" in self.opponent_agents.keys()):
-            new_opponent_policy = "imitation" 
+        if policy == _SELF_PLAY and self.is_valid_opponent_model_update():
+            new_opponent_policy = _SELF_PLAY
+        elif policy == _IMITATION:
+            new_opponent_policy = _IMITATION
 
         if current_opponent_policy != new_opponent_policy:
             self.opponent_policy = new_opponent_policy
@@ -0,0 +1,463 @@
+"""
+Implements helpers for running several Lux environments in parallel
+"""
+import collections
+import copy
+import multiprocessing
+from multiprocessing.connection import wait
+
+import numpy as np
+import torch
+from stable_baselines3.common.env_util import is_wrapped
+from stable_baselines3.common.utils import set_random_seed
+from stable_baselines3.common.vec_env.base_vec_env import CloudpickleWrapper, VecEnv, VecEnvWrapper
+
+from .lux_env import LuxEnvironment, _get_mp_context
+
+
+def make_lux_env(rank, configs, learning_agent_ctor, opponent_agents_ctor, seed=0, **env_kwargs):
+    """
+    Utility function for multi-processed env. Returns a thunk that creates a fresh
+    LuxEnvironment, eg:
+        SubprocVecEnv([make_lux_env(i, configs, ...) for i in range(n_envs)], start_method="spawn")
+
+    The agents are constructed inside the thunk so that every worker owns its own agents
+    and models, instead of sharing the ones of the parent process.
+
+    :param rank: (int) index of the subprocess
+    :param configs: (dict) the game configs, copied for each environment
+    :param learning_agent_ctor: (callable) returns the learning agent
+    :param opponent_agents_ctor: (callable) returns the dict of opponent agents
+    :param seed: (int) the initial seed for RNG of the worker process, environments created in
+        the current process (eg by LuxVecEnvironment) don't reseed it
+    :param env_kwargs: additional keyword arguments to LuxEnvironment
+    :return: (callable) thunk that returns the environment
+    """
+
+    def _init():
+        if multiprocessing.current_process().name != "MainProcess":
+            # Every worker runs its own opponent models, don't oversubscribe the cores
+            torch.set_num_threads(1)
+            # Only seed workers, in the training process this would reseed the random
+            # generators of the trainer
+            set_random_seed(seed + rank)
+
+        return LuxEnvironment(configs=copy.deepcopy(configs),
+                              learning_agent=learning_agent_ctor(),
+                              opponent_agents=opponent_agents_ctor(),
+                              **env_kwargs)
+
+    return _init
+
+
+def make_lux_vec_env(n_envs, configs, learning_agent_ctor, opponent_agents_ctor, seed=0, start_method="spawn", **env_kwargs):
+    """
+    Creates ``n_envs`` Lux environments as one VecEnv, eg:
+        env = make_lux_vec_env(8, configs, partial(AgentPolicy, mode="train"), lambda: {"default": Agent()})
+
+    Several environments each run in their own process with ShmemLuxVecEnv, a single one
+    runs in the current process.
+
+    :param n_envs: (int) number of environments
+    :param configs: (dict) the game configs, copied for each environment
+    :param learning_agent_ctor: (callable) returns the learning agent
+    :param opponent_agents_ctor: (callable) returns the dict of opponent agents
+    :param seed: (int) the initial seed for RNG, the worker of environment i uses seed + i. A
+        single environment runs in the current process and leaves its RNG seeds as they are
+    :param start_method: (str) multiprocessing start method of the workers
+    :param env_kwargs: additional keyword arguments to LuxEnvironment
+    :return: (VecEnv) the environments
+    """
+    env_fns = [
+        make_lux_env(i, configs, learning_agent_ctor, opponent_agents_ctor, seed=seed, **env_kwargs)
+        for i in range(n_envs)
+    ]
+    if n_envs == 1:
+        return LuxVecEnvironment(env_fns)
+    return ShmemLuxVecEnv(env_fns, start_method=start_method)
+
+
+class LuxVecEnvironment(VecEnv):
+    """
+    Runs several Lux environments one after the other in the current process, as a
+    VecEnv. Equivalent to a DummyVecEnv of the same environments, but the observations
+    are written straight into one preallocated batch.
+
+    :param env_fns: ([callable]) environment thunks, see make_lux_env()
+    """
+
+    def __init__(self, env_fns):
+        self.envs = [fn() for fn in env_fns]
+        env = self.envs[0]
+        super().__init__(len(env_fns), env.observation_space, env.action_space)
+
+        self._obs = np.zeros((self.num_envs,) + self.observation_space.shape, dtype=self.observation_space.dtype)
+        self._rewards = np.zeros((self.num_envs,), dtype=np.float32)
+        self._dones = np.zeros((self.num_envs,), dtype=bool)
+        self._actions = None
+
+    def reset(self):
+        for i, env in enumerate(self.envs):
+            self._obs[i] = env.reset()
+        return self._obs.copy()
+
+    def step_async(self, actions):
+        self._actions = actions
+
+    def step_wait(self):
+        infos = []
+        for i, (env, action) in enumerate(zip(self.envs, self._actions)):
+            obs, self._rewards[i], self._dones[i], info = env.step(action)
+            if self._dones[i] and "terminal_observation" not in info:
+                # Start the next game, unless the env autoresets. The final observation of a
+                # LuxEnvironment is None, there is nothing left to observe at the end of a game
+                info["terminal_observation"] = obs
+                obs = env.reset()
+            self._obs[i] = obs
+            infos.append(info)
+
+        # The batch is reused by the next step, SB3 keeps the returned observations around
+        return self._obs.copy(), self._rewards.copy(), self._dones.copy(), infos
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+    def seed(self, seed=None):
+        return [env.seed(None if seed is None else seed + i) for i, env in enumerate(self.envs)]
+
+    def get_attr(self, attr_name, indices=None):
+        return [getattr(self.envs[i], attr_name) for i in self._get_indices(indices)]
+
+    def set_attr(self, attr_name, value, indices=None):
+        for i in self._get_indices(indices):
+            setattr(self.envs[i], attr_name, value)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        return [getattr(self.envs[i], method_name)(*method_args, **method_kwargs) for i in self._get_indices(indices)]
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        return [is_wrapped(self.envs[i], wrapper_class) for i in self._get_indices(indices)]
+
+
+def _async_worker(remote, parent_remote, env_fn_wrapper, env_id, obs_buffer, obs_shape, obs_dtype):
+    """
+    Runs one environment of an AsyncLuxVecEnv or ShmemLuxVecEnv. Observations are written
+    to this environment's slot of the shared observation buffer instead of being sent
+    through the pipe. Finished episodes are reset automatically, so the slot always holds
+    a valid observation.
+    """
+    parent_remote.close()
+    env = env_fn_wrapper.var()
+    obs_slot = np.frombuffer(obs_buffer, dtype=obs_dtype).reshape((-1,) + obs_shape)[env_id]
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == "step":
+                obs, reward, done, info = env.step(data)
+                if done and "terminal_observation" not in info:
+                    info["terminal_observation"] = obs
+                    obs = env.reset()
+                obs_slot[...] = obs
+                remote.send((env_id, reward, done, info))
+            elif cmd == "reset":
+                obs_slot[...] = env.reset()
+                remote.send((env_id, 0.0, False, {}))
+            elif cmd == "close":
+                remote.close()
+                break
+            elif cmd == "seed":
+                remote.send(env.seed(data))
+            elif cmd == "env_method":
+                method = getattr(env, data[0])
+                remote.send(method(*data[1], **data[2]))
+            elif cmd == "get_attr":
+                remote.send(getattr(env, data))
+            elif cmd == "set_attr":
+                remote.send(setattr(env, data[0], data[1]))
+            elif cmd == "is_wrapped":
+                remote.send(is_wrapped(env, data))
+            else:
+                raise NotImplementedError(f"`{cmd}` is not implemented in the worker")
+    except KeyboardInterrupt:
+        print("Lux environment worker: got KeyboardInterrupt")
+    finally:
+        env.close()
+
+
+def _spaces_worker(remote, env_fn_wrapper):
+    """
+    Sends the (observation_space, action_space) of an environment, see _start_workers().
+    """
+    env = env_fn_wrapper.var()
+    remote.send((env.observation_space, env.action_space))
+    env.close()
+    remote.close()
+
+
+def _start_workers(env_fns, start_method):
+    """
+    Starts one _async_worker process per environment.
+    :return: (observation_space, action_space, obs, remotes, processes), obs being the
+             (n_envs, *obs_shape) view of the observation buffer shared with the workers.
+    """
+    ctx = _get_mp_context() if start_method is None else multiprocessing.get_context(start_method)
+
+    # The spaces size the shared buffer, so they are needed before the workers start. Read them
+    # from a short-lived process, creating an environment here would construct its agents and
+    # models in this process, and make_lux_env() would reseed its random generators.
+    remote, work_remote = ctx.Pipe()
+    process = ctx.Process(target=_spaces_worker, args=(work_remote, CloudpickleWrapper(env_fns[0])), daemon=True)
+    process.start()
+    work_remote.close()
+    observation_space, action_space = remote.recv()
+    process.join()
+    remote.close()
+
+    # One observation slot per environment, written by the workers
+    n_envs = len(env_fns)
+    obs_shape, obs_dtype = observation_space.shape, observation_space.dtype
+    obs_buffer = ctx.RawArray("b", n_envs * int(np.prod(obs_shape)) * obs_dtype.itemsize)
+    obs = np.frombuffer(obs_buffer, dtype=obs_dtype).reshape((n_envs,) + obs_shape)
+
+    remotes, work_remotes = zip(*[ctx.Pipe() for _ in range(n_envs)])
+    processes = []
+    for env_id, (work_remote, remote, env_fn) in enumerate(zip(work_remotes, remotes, env_fns)):
+        args = (work_remote, remote, CloudpickleWrapper(env_fn), env_id, obs_buffer, obs_shape, obs_dtype)
+        # daemon=True: if the main process crashes, we should not cause things to hang
+        process = ctx.Process(target=_async_worker, args=args, daemon=True)
+        process.start()
+        processes.append(process)
+        work_remote.close()
+
+    return observation_space, action_space, obs, remotes, processes
+
+
+class ShmemLuxVecEnv(VecEnv):
+    """
+    Drop-in replacement for SubprocVecEnv, where the workers write their observations
+    into shared memory instead of pickling them through the pipes. Only the rewards,
+    dones and infos are sent back. Eg:
+        env = ShmemLuxVecEnv([make_lux_env(i, ...) for i in range(n_envs)])
+
+    :param env_fns: ([callable]) environment thunks, see make_lux_env()
+    :param start_method: (str) multiprocessing start method
+    """
+
+    def __init__(self, env_fns, start_method=None):
+        observation_space, action_space, self._obs, self.remotes, self.processes = _start_workers(
+            env_fns, start_method
+        )
+        super().__init__(len(env_fns), observation_space, action_space)
+        self.waiting = False
+        self.closed = False
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        for remote in self.remotes:
+            remote.recv()
+        return self._obs.copy()
+
+    def step_async(self, actions):
+        for remote, action in zip(self.remotes, actions):
+            remote.send(("step", action))
+        self.waiting = True
+
+    def step_wait(self):
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        _, rewards, dones, infos = zip(*results)
+        # The workers overwrite the shared observations on the next step
+        return self._obs.copy(), np.array(rewards, dtype=np.float32), np.array(dones), list(infos)
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
+
+    def seed(self, seed=None):
+        for i, remote in enumerate(self.remotes):
+            remote.send(("seed", None if seed is None else seed + i))
+        return [remote.recv() for remote in self.remotes]
+
+    def get_attr(self, attr_name, indices=None):
+        remotes = self._get_target_remotes(indices)
+        for remote in remotes:
+            remote.send(("get_attr", attr_name))
+        return [remote.recv() for remote in remotes]
+
+    def set_attr(self, attr_name, value, indices=None):
+        remotes = self._get_target_remotes(indices)
+        for remote in remotes:
+            remote.send(("set_attr", (attr_name, value)))
+        for remote in remotes:
+            remote.recv()
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        remotes = self._get_target_remotes(indices)
+        for remote in remotes:
+            remote.send(("env_method", (method_name, method_args, method_kwargs)))
+        return [remote.recv() for remote in remotes]
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        remotes = self._get_target_remotes(indices)
+        for remote in remotes:
+            remote.send(("is_wrapped", wrapper_class))
+        return [remote.recv() for remote in remotes]
+
+    def _get_target_remotes(self, indices):
+        return [self.remotes[i] for i in self._get_indices(indices)]
+
+
+class AsyncLuxVecEnv:
+    """
+    Asynchronous pool of environments, each running in its own process. Mirrors the
+    EnvPool send/recv interface: recv() returns the first ``batch_size`` environments
+    that finished stepping, so a slow game doesn't stall the whole batch. Actions are
+    then sent back to those specific environments, eg:
+
+        env = AsyncLuxVecEnv([make_lux_env(i, ...) for i in range(16)], batch_size=8)
+        env.async_reset()
+        while training:
+            obs, rewards, dones, infos, env_ids = env.recv()
+            env.send(policy(obs), env_ids)
+
+    Observations are passed back through shared memory rather than pickled. The observation
+    space is read from a short-lived process, which creates the first environment once.
+
+    :param env_fns: ([callable]) environment thunks, see make_lux_env()
+    :param batch_size: (int) number of environments returned by each recv(). Defaults to all of them.
+    :param start_method: (str) multiprocessing start method
+    """
+
+    def __init__(self, env_fns, batch_size=None, start_method=None):
+        self.num_envs = len(env_fns)
+        self.batch_size = self.num_envs if batch_size is None else batch_size
+        if not 0 < self.batch_size <= self.num_envs:
+            raise ValueError("batch_size must be between 1 and the number of environments.")
+
+        self.observation_space, self.action_space, self._obs, self.remotes, self.processes = _start_workers(
+            env_fns, start_method
+        )
+
+        self.outstanding = set()  # Environments that were sent a command, but haven't replied
+        self.ready = collections.deque()  # Replies not yet returned by recv()
+        self.closed = False
+
+    def async_reset(self):
+        """
+        Resets all the environments. The first observations are returned by recv().
+        """
+        self.ready.clear()
+        self.outstanding = set(range(self.num_envs))
+        for remote in self.remotes:
+            remote.send(("reset", None))
+
+    def send(self, actions, env_ids):
+        """
+        Steps the specified environments with the specified actions, without waiting.
+        :param actions: Actions, one per environment in env_ids.
+        :param env_ids: Ids of the environments, as returned by recv().
+        """
+        for action, env_id in zip(actions, env_ids):
+            if env_id in self.outstanding:
+                raise ValueError(f"Environment {env_id} is still running its previous step.")
+            self.remotes[env_id].send(("step", action))
+            self.outstanding.add(env_id)
+
+    def recv(self):
+        """
+        Waits for the first ``batch_size`` environments to be ready.
+        :return: (obs, rewards, dones, infos, env_ids) batched over the ready environments.
+                 infos[i]["env_id"] is the same as env_ids[i].
+        """
+        while len(self.ready) < self.batch_size:
+            if len(self.outstanding) + len(self.ready) < self.batch_size:
+                raise RuntimeError("Not enough environments are running to fill a batch, call send() first.")
+            for remote in wait([self.remotes[env_id] for env_id in self.outstanding]):
+                result = remote.recv()
+                self.outstanding.discard(result[0])
+                self.ready.append(result)
+
+        results = [self.ready.popleft() for _ in range(self.batch_size)]
+        env_ids, rewards, dones, infos = zip(*results)
+        for env_id, info in zip(env_ids, infos):
+            info["env_id"] = env_id
+
+        env_ids = np.array(env_ids)
+        return self._obs[env_ids], np.array(rewards, dtype=np.float32), np.array(dones), list(infos), env_ids
+
+    def step(self, actions, env_ids):
+        """
+        Sends the actions, then waits for the next batch of ready environments.
+        """
+        self.send(actions, env_ids)
+        return self.recv()
+
+    def close(self):
+        if self.closed:
+            return
+        for env_id in list(self.outstanding):
+            self.remotes[env_id].recv()
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
+
+
+class VecEncodeObservation(VecEnvWrapper):
+    """
+    Runs a torch observation encoder once over the observations of all the
+    environments, instead of once per environment inside get_observation(). The agents
+    then only build the cheap raw state in the workers, and the encoder runs batched,
+    eg on the GPU of the training process:
+
+        env = VecEncodeObservation(SubprocVecEnv(env_fns), encoder, encoded_space, device="cuda")
+
+    The "terminal_observation" of finished episodes are encoded as well when they aren't None,
+    in one extra call.
+
+    :param venv: (VecEnv) the environments, returning raw observations
+    :param encoder: (callable) torch module or function mapping a (n_envs, ...) tensor of raw
+        observations to a (n_envs, ...) tensor of encoded observations
+    :param observation_space: (gym.spaces.Box) the space of the encoded observations
+    :param device: (str or torch.device) device to run the encoder on
+    """
+
+    def __init__(self, venv, encoder, observation_space, device="cpu"):
+        super().__init__(venv, observation_space=observation_space)
+        self.encoder = encoder
+        self.device = torch.device(device)
+
+    def encode(self, obs):
+        """
+        Encodes a batch of raw observations.
+        """
+        with torch.no_grad():
+            batch = torch.as_tensor(obs, device=self.device)
+            encoded = self.encoder(batch)
+        return encoded.cpu().numpy().astype(self.observation_space.dtype, copy=False)
+
+    def reset(self):
+        return self.encode(self.venv.reset())
+
+    def step_wait(self):
+        obs, rewards, dones, infos = self.venv.step_wait()
+        obs = self.encode(obs)
+
+        terminal = [i for i, info in enumerate(infos) if info.get("terminal_observation") is not None]
+        if terminal:
+            encoded = self.encode(np.stack([infos[i]["terminal_observation"] for i in terminal]))
+            for i, terminal_obs in zip(terminal, encoded):
+                infos[i]["terminal_observation"] = terminal_obs
+
+        return obs, rewards, dones, infos
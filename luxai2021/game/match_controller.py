@@ -1,8 +1,8 @@
 from luxai2021.game.city import CityTile
 import random
 import sys
-import time
 import traceback
+from collections import deque
 
 from .constants import Constants
 from ..env.agent import Agent
@@ -134,6 +134,14 @@ class MatchController:
         for agent in self.agents:
             agent.game_start(self.game)
 
+        # Start stepping the game from its first turn with advance()
+        self._game_over = False
+        self._is_first_turn = True
+        self._in_turn = False
+        self._agent_index = 0  # Next agent to process this turn
+        self._pending = deque()  # Units and city tiles of the learning agent left to observe this turn
+        self._new_turn = True
+
     def take_action(self, action):
         """
          Adds the specified action to the action buffer
@@ -211,114 +219,141 @@ class MatchController:
             if a != agent:
                 a.set_team(team)
 
-    def run_to_next_observation(self):
-        """ 
-            Generator function that gets the observation at the next Unit/City
-            to be controlled.
-            Returns: tuple describing the unit who's control decision is for (unit_id, city, team, is new turn)
+    def advance(self):
         """
-        game_over = False
-        is_first_turn = True
-        while not game_over:
-            turn = self.game.state["turn"]
-
-            # Run pre-turn agent events to allow for them to handle running the turn instead (used in a kaggle submission agent)
-            for agent in self.agents:
-                agent.pre_turn(self.game, is_first_turn)
-
-            # Process any pending action sequences to automatically apply actions to units for this turn
-            for id in list(self.action_sequences.keys()):
-                sequence = self.action_sequences[id]
-                actionable = None
-                if id in self.game.state["teamStates"][0]["units"]:
-                    actionable = self.game.state["teamStates"][0]["units"][id]
-                elif id in self.game.state["teamStates"][1]["units"]:
-                    actionable = self.game.state["teamStates"][1]["units"][id]
-                elif isinstance(id, CityTile):
-                    # Validate the city still exists
-                    if id.city_id in self.game.cities:
-                        actionable = id
-                else:
-                    # The unit must no longer exist
-                    pass
-
-                if actionable != None and actionable.can_act():
-                    # Continue the action sequence for this unit automatically
-                    self.take_action(sequence.get_next_action(self.game))
-
-                    if sequence.is_done():
-                        self.action_sequences.pop(id)
-                elif actionable == None:
-                    # Delete the action sequence, the object isn't valid anymore
-                    self.action_sequences.pop(id)
-            
-            # Run agent.turn_heurstics() to apply any agent heristics to give units orders
-            for agent in self.agents:
-                agent.turn_heurstics(self.game, is_first_turn)
-
-            # Process this turn
-            for agent in self.agents:
+        Steps the game to the next Unit/City to be controlled by the learning agent.
+        The game restarts from its first turn after reset().
+        Returns: tuple describing the unit who's control decision is for (unit, city_tile, team, is new turn),
+                 or None once the game is over.
+        """
+        while True:
+            if not self._in_turn:
+                if self._game_over:
+                    return None
+                self._start_turn()
+
+            # Observe the learning agent's units, then cities, that can still act
+            while self._pending:
+                unit, city_tile = self._pending.popleft()
+                actionable = unit if unit is not None else city_tile
+                if actionable.can_act():
+                    # RL training agent that is controlling the simulation
+                    # The enviornment then handles this unit or city, and calls take_action() to buffer a requested action
+                    new_turn = self._new_turn
+                    self._new_turn = False
+                    return unit, city_tile, actionable.team, new_turn
+
+            if self._agent_index < len(self.agents):
+                # Process this turn
+                agent = self.agents[self._agent_index]
+                self._agent_index += 1
                 if agent.get_agent_type() == Constants.AGENT_TYPE.AGENT:
                     # Call the agent for the set of actions
                     actions = agent.process_turn(self.game, agent.team)
                     self.take_actions(actions)
 
                 elif agent.get_agent_type() == Constants.AGENT_TYPE.LEARNING:
-                    # Yield the game to make a decision, since the learning environment is the function caller
-                    new_turn = True
-                    start_time = time.time()
-
-                    units = self.game.state["teamStates"][agent.team]["units"].values()
-                    for unit in units:
-                        if unit.can_act():
-                            # RL training agent that is controlling the simulation
-                            # The enviornment then handles this unit, and calls take_action() to buffer a requested action
-                            yield unit, None, unit.team, new_turn
-                            new_turn = False
-                            
-
-                    cities = self.game.cities.values()
-                    for city in cities:
+                    # Return the game to make a decision, since the learning environment is the function caller
+                    self._new_turn = True
+                    for unit in self.game.state["teamStates"][agent.team]["units"].values():
+                        self._pending.append((unit, None))
+                    for city in self.game.cities.values():
                         if city.team == agent.team:
                             for cell in city.city_cells:
-                                city_tile = cell.city_tile
-                                if city_tile.can_act():
-                                    # RL training agent that is controlling the simulation
-                                    # The enviornment then handles this city, and calls take_action() to buffer a requested action
-                                    yield None, city_tile, city_tile.team, new_turn
-                                    new_turn = False
-
-                    time_taken = time.time() - start_time
-            
-            # Reset the can_act overrides for all units and city_tiles
-            units = list(self.game.state["teamStates"][0]["units"].values()) + list(self.game.state["teamStates"][1]["units"].values())
-            for unit in units:
-                unit.set_can_act_override(None)
-            for city in self.game.cities.values():
-                for cell in city.city_cells:
-                    city_tile = cell.city_tile.set_can_act_override(None)
-
-            is_first_turn = False
-
-            # Now let the game actually process the requested actions and play the turn
-            try:
-                # Run post-turn agent events to allow for them to handle running the turn instead (used in a kaggle submission agent)
-                self.accumulated_stats = dict( {Constants.TEAM.A: {}, Constants.TEAM.B: {}} )
-                handled = False
-                for agent in self.agents:
-                    if agent.post_turn(self.game, self.action_buffer):
-                        handled = True
-
-                if not handled:
-                    game_over = self.game.run_turn_with_actions(self.action_buffer)
-            except Exception as e:
-                # Log exception
-                self.log_error("ERROR: Critical error occurred in turn simulation.")
-                self.log_error(repr(e))
-                self.log_error(''.join(traceback.format_exception(None, e, e.__traceback__)))
-                raise GameStepFailedException("Critical error occurred in turn simulation.")
-
-            self.action_buffer = []
-
-            if self.replay_validate is not None:
-                self.game.process_updates(self.replay_validate['steps'][turn+1][0]['observation']['updates'], assign=False)
+                                self._pending.append((None, cell.city_tile))
+            else:
+                self._end_turn()
+
+    def _start_turn(self):
+        """
+        Runs the turn events that happen before the agents decide on their actions.
+        """
+        self._in_turn = True
+        self._agent_index = 0
+        self._turn = self.game.state["turn"]
+
+        # Run pre-turn agent events to allow for them to handle running the turn instead (used in a kaggle submission agent)
+        for agent in self.agents:
+            agent.pre_turn(self.game, self._is_first_turn)
+
+        # Process any pending action sequences to automatically apply actions to units for this turn
+        for id in list(self.action_sequences.keys()):
+            sequence = self.action_sequences[id]
+            actionable = None
+            if id in self.game.state["teamStates"][0]["units"]:
+                actionable = self.game.state["teamStates"][0]["units"][id]
+            elif id in self.game.state["teamStates"][1]["units"]:
+                actionable = self.game.state["teamStates"][1]["units"][id]
+            elif isinstance(id, CityTile):
+                # Validate the city still exists
+                if id.city_id in self.game.cities:
+                    actionable = id
+            else:
+                # The unit must no longer exist
+                pass
+
+            if actionable != None and actionable.can_act():
+                # Continue the action sequence for this unit automatically
+                self.take_action(sequence.get_next_action(self.game))
+
+                if sequence.is_done():
+                    self.action_sequences.pop(id)
+            elif actionable == None:
+                # Delete the action sequence, the object isn't valid anymore
+                self.action_sequences.pop(id)
+        
+        # Run agent.turn_heurstics() to apply any agent heristics to give units orders
+        for agent in self.agents:
+            agent.turn_heurstics(self.game, self._is_first_turn)
+
+    def _end_turn(self):
+        """
+        Simulates the turn with the buffered actions of both agents.
+        """
+        self._in_turn = False
+
+        # Reset the can_act overrides for all units and city_tiles
+        units = list(self.game.state["teamStates"][0]["units"].values()) + list(self.game.state["teamStates"][1]["units"].values())
+        for unit in units:
+            unit.set_can_act_override(None)
+        for city in self.game.cities.values():
+            for cell in city.city_cells:
+                city_tile = cell.city_tile.set_can_act_override(None)
+
+        self._is_first_turn = False
+
+        # Now let the game actually process the requested actions and play the turn
+        try:
+            # Run post-turn agent events to allow for them to handle running the turn instead (used in a kaggle submission agent)
+            self.accumulated_stats = dict( {Constants.TEAM.A: {}, Constants.TEAM.B: {}} )
+            handled = False
+            for agent in self.agents:
+                if agent.post_turn(self.game, self.action_buffer):
+                    handled = True
+
+            if not handled:
+                self._game_over = self.game.run_turn_with_actions(self.action_buffer)
+        except Exception as e:
+            # Log exception
+            self.log_error("ERROR: Critical error occurred in turn simulation.")
+            self.log_error(repr(e))
+            self.log_error(''.join(traceback.format_exception(None, e, e.__traceback__)))
+            self._game_over = True
+            raise GameStepFailedException("Critical error occurred in turn simulation.")
+
+        self.action_buffer = []
+
+        if self.replay_validate is not None:
+            self.game.process_updates(self.replay_validate['steps'][self._turn+1][0]['observation']['updates'], assign=False)
+
+    def run_to_next_observation(self):
+        """ 
+            Generator function that gets the observation at the next Unit/City
+            to be controlled.
+            Returns: tuple describing the unit who's control decision is for (unit_id, city, team, is new turn)
+        """
+        while True:
+            observation = self.advance()
+            if observation is None:
+                return
+            yield observation
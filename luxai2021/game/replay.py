@@ -1,9 +1,66 @@
 
+import atexit
 import json
+import os
+import queue
+import threading
+import traceback
 from luxai2021.game.actions import Action
 from typing import List
 from .constants import Constants
 
+
+# Replays are written to disk by a background thread, so the game doesn't wait on
+# serializing and writing the whole replay when a match ends.
+_write_queue = None
+_write_lock = threading.Lock()
+
+
+def _replay_writer(write_queue):
+    while True:
+        file, data = write_queue.get()
+        try:
+            with open(file, "w") as o:
+                json.dump(data, o)
+        except Exception as e:
+            print(f"Failed to write replay {file}: {repr(e)}")
+            traceback.print_exc()
+        finally:
+            write_queue.task_done()
+
+
+def _get_write_queue():
+    global _write_queue
+    with _write_lock:
+        if _write_queue is None:
+            _write_queue = queue.Queue()
+            threading.Thread(target=_replay_writer, args=(_write_queue,), daemon=True).start()
+            atexit.register(flush_replays)
+    return _write_queue
+
+
+def _reset_write_queue():
+    """
+    Runs in forked children, which don't inherit the writer thread. Their replays
+    go to a new queue and thread, the queued ones are left to the parent.
+    """
+    global _write_queue, _write_lock
+    _write_queue = None
+    _write_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_write_queue)
+
+
+def flush_replays():
+    """
+    Waits for all the replays queued by Replay.write() to be written to disk.
+    """
+    if _write_queue is not None:
+        _write_queue.join()
+
+
 class Replay:
     """
     Implements saving of replays. Loosely mirrors '/src/Replay/index.ts'
@@ -70,13 +127,13 @@ class Replay:
     
     def write(self, game) -> None:
         """
-        Write this replay to the specified target file.
+        Write this replay to the specified target file. The file is written in the background,
+        call flush_replays() to wait for it.
         """
         self.data['width'] = game.map.width
         self.data['height'] = game.map.height
 
-        with open(self.file, "w") as o:
-            # Write the replay file
-            json.dump(self.data, o)
+        # Hand the replay over to the writer thread, it isn't modified after this
+        _get_write_queue().put((self.file, self.data))
 
     
\ No newline at end of file
@@ -0,0 +1,88 @@
+import pytest
+from gym import spaces
+from luxai2021.game.constants import LuxMatchConfigs_Default
+from luxai2021.game.game import Game
+from luxai2021.game.match_controller import GameStepFailedException, MatchController
+from luxai2021.env.agent import Agent, AgentWithModel
+
+
+class LearningAgent(AgentWithModel):
+    """
+    Learning agent that never gives its units or cities an action.
+    """
+    def __init__(self) -> None:
+        super().__init__(mode="train")
+        self.action_space = spaces.Discrete(1)
+
+    def get_observation(self, game, unit, city_tile, team, is_new_turn=False, out=None):
+        # LuxEnvironment doesn't pass is_new_turn to agents without get_base_observation()
+        return super().get_observation(game, unit, city_tile, team, is_new_turn, out=out)
+
+    def take_action(self, action_code, game, unit=None, city_tile=None, team=None):
+        pass
+
+
+def make_controller(learning=True):
+    config = LuxMatchConfigs_Default.copy()
+    config["seed"] = 1
+    agent = LearningAgent() if learning else Agent()
+    return MatchController(Game(config), agents=[agent, Agent()])
+
+
+def test_advance_returns_none_at_game_end():
+    controller = make_controller()
+
+    observations = 0
+    observation = controller.advance()
+    while observation is not None:
+        unit, city_tile, team, is_new_turn = observation
+        assert (unit is None) != (city_tile is None)
+        assert team == controller.agents[0].team
+        observations += 1
+        observation = controller.advance()
+
+    assert observations > 0
+    assert controller.game.match_over()
+    # Stays at the end of the game until reset
+    assert controller.advance() is None
+
+
+def test_advance_plays_whole_game_without_learning_agent():
+    controller = make_controller(learning=False)
+
+    assert controller.advance() is None
+    assert controller.game.match_over()
+
+
+def test_advance_returns_none_after_failed_step():
+    controller = make_controller(learning=False)
+
+    def fail(actions):
+        raise RuntimeError("turn failed")
+    controller.game.run_turn_with_actions = fail
+    controller.log_error = lambda text: None
+
+    with pytest.raises(GameStepFailedException):
+        controller.advance()
+    assert controller.advance() is None
+
+
+def test_reset_restarts_turn_state():
+    controller = make_controller()
+
+    # Stop in the middle of a later turn
+    while controller.game.state["turn"] < 3:
+        assert controller.advance() is not None
+    controller.advance()
+
+    controller.reset()
+    assert controller.game.state["turn"] == 0
+    unit, city_tile, team, is_new_turn = controller.advance()
+    assert is_new_turn
+    assert controller.game.state["turn"] == 0
+
+    # Also restarts a finished game
+    while controller.advance() is not None:
+        pass
+    controller.reset()
+    assert controller.advance() is not None
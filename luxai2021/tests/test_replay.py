@@ -28,7 +28,7 @@ def test_run_replay(replay_id):
 
     env = LuxEnvironment(configs=config,
                         learning_agent=agent,
-                        opponent_agent=opponent,
+                        opponent_agents={"imitation": opponent},
                         replay_validate=json_args)
 
     is_game_error = env.run_no_learn()
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+from luxai2021.game.constants import LuxMatchConfigs_Default
+from luxai2021.env.agent import Agent
+from luxai2021.env import vec_env
+from luxai2021.env.vec_env import AsyncLuxVecEnv, LuxVecEnvironment, ShmemLuxVecEnv, make_lux_env, make_lux_vec_env
+from .test_match_controller import LearningAgent
+
+
+def make_env_fns(n_envs, **env_kwargs):
+    return [
+        make_lux_env(i, LuxMatchConfigs_Default, LearningAgent, lambda: {"imitation": Agent()}, seed=1, **env_kwargs)
+        for i in range(n_envs)
+    ]
+
+
+def run_through_game_end(env, n_envs):
+    obs = env.reset()
+    assert obs.shape == (n_envs,) + env.observation_space.shape
+
+    games = np.zeros(n_envs, dtype=int)
+    while games.min() < 1:
+        obs, rewards, dones, infos = env.step(np.zeros(n_envs, dtype=int))
+        assert obs.shape == (n_envs,) + env.observation_space.shape
+        for i in np.nonzero(dones)[0]:
+            assert "terminal_observation" in infos[i]
+            # The next game has started
+            assert env.get_attr("current_step", indices=[i]) == [0]
+        games += dones
+
+
+@pytest.mark.parametrize("autoreset", [False, True])
+def test_lux_vec_env_runs_through_game_end(autoreset):
+    env = LuxVecEnvironment(make_env_fns(2, autoreset=autoreset))
+    run_through_game_end(env, 2)
+    env.close()
+
+
+def test_shmem_vec_env_runs_through_game_end():
+    env = ShmemLuxVecEnv(make_env_fns(2))
+    run_through_game_end(env, 2)
+
+    env.close()
+    assert all(not process.is_alive() and process.exitcode == 0 for process in env.processes)
+
+
+def test_async_vec_env_returns_batches_of_ready_envs():
+    n_envs, batch_size = 3, 2
+    env = AsyncLuxVecEnv(make_env_fns(n_envs), batch_size=batch_size)
+    env.async_reset()
+
+    for _ in range(5):
+        obs, rewards, dones, infos, env_ids = env.recv()
+        assert obs.shape == (batch_size,) + env.observation_space.shape
+        assert len(rewards) == len(dones) == len(infos) == len(env_ids) == batch_size
+        assert len(set(env_ids)) == batch_size
+        assert [info["env_id"] for info in infos] == list(env_ids)
+
+        env.send(np.zeros(batch_size, dtype=int), env_ids)
+        # These environments are stepping until the next recv() returns them
+        with pytest.raises(ValueError):
+            env.send(np.zeros(1, dtype=int), env_ids[:1])
+
+    env.close()
+    assert all(not process.is_alive() and process.exitcode == 0 for process in env.processes)
+
+
+def test_make_lux_vec_env_single_env_keeps_trainer_seed(monkeypatch):
+    seeds = []
+    monkeypatch.setattr(vec_env, "set_random_seed", seeds.append)
+
+    env = make_lux_vec_env(1, LuxMatchConfigs_Default, LearningAgent, lambda: {"imitation": Agent()}, seed=1)
+    assert isinstance(env, LuxVecEnvironment)
+    # The environment runs in this process, it must not reseed the trainer
+    assert seeds == []
+
+    env.close()